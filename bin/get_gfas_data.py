@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 """=============================================================================
-Download GFAS biomass burning data for a single month.
+Download GFAS biomass burning data for one or more months.
 
-Download a month's worth of GFAS biomass burning data from ECMWF CDS. All data
-fields are downloaded into a single NetCDF file named GFAS_RAW_YYYY_MM.nc. This
+Download months of GFAS biomass burning data from ECMWF CDS. All data fields
+for a month are downloaded into a single NetCDF file named GFAS_RAW_YYYY_MM.nc.
+Months are retrieved concurrently, as time-to-download is dominated by CDS
+server-side queue time, and queue waits for separate requests can overlap. This
 script is intended to be the first part of a Download => Preprocess => Transfer
 pipeline from ECMWF CDS to GCST.
 ============================================================================="""
 import argparse
 import calendar
+import concurrent.futures
 import datetime
+import functools
 import logging
 import os
 
 import cdsapi
 
+from gfas_constants import CDS_REQUEST_TEMPLATE
+
+# Maximum number of concurrent CDS requests. Kept low to respect CDS fair-use
+# limits - raising this is likely to get requests queued behind each other
+# server-side anyway.
+MAX_CONCURRENT_DOWNLOADS: int = 4
+
 
 def date_string(string: str) -> datetime.date:
     """
@@ -79,10 +90,11 @@ def parse_command_line() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        "month",
+        "months",
         type=date_string,
         metavar="month {YYYY-MM}",
-        help="The month of GFAS data to retrieve",
+        nargs="+",
+        help="The month(s) of GFAS data to retrieve",
     )
 
     parser.add_argument(
@@ -95,74 +107,63 @@ def parse_command_line() -> argparse.Namespace:
         help="Directory in which to store downloaded data files",
     )
 
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help=(
+            "Download data even when the output file for a month already "
+            "exists"
+        ),
+    )
+
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help=(
+            "Retrieve everything from the earliest to the latest passed "
+            "month in a single CDS request and output file, paying one CDS "
+            "queue wait instead of one per month"
+        ),
+    )
+
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
-    COMMAND_LINE: argparse.Namespace = parse_command_line()
+@functools.lru_cache(maxsize=None)
+def month_end(month: datetime.date) -> datetime.date:
+    """
+    Return the date of the last day of the passed month. Inputs repeat across
+    the per-month and batched paths, so results are memoised.
+
+    Args:
+        month: A datetime.date falling on the first day of a month.
 
-    START_DATE: datetime.date = COMMAND_LINE.month
-    END_DATE: datetime.date = START_DATE + datetime.timedelta(
-        days=calendar.monthrange(START_DATE.year, START_DATE.month)[1] - 1
+    Returns:
+        A datetime.date representing the final day of that month.
+    """
+    return month + datetime.timedelta(
+        days=calendar.monthrange(month.year, month.month)[1] - 1
     )
 
-    CDS_DATE_STRING: str = f"{START_DATE}/{END_DATE}"
-    CDS_DATA_FIELDS: list[str] = [
-        "altitude_of_plume_top",
-        "altitude_of_plume_bottom",
-        "injection_height",
-        "mean_altitude_of_maximum_injection",
-        "wildfire_combustion_rate",
-        "wildfire_flux_of_acetaldehyde",
-        "wildfire_flux_of_acetone",
-        "wildfire_flux_of_ammonia",
-        "wildfire_flux_of_benzene",
-        "wildfire_flux_of_black_carbon",
-        "wildfire_flux_of_butanes",
-        "wildfire_flux_of_butenes",
-        "wildfire_flux_of_carbon_dioxide",
-        "wildfire_flux_of_carbon_monoxide",
-        "wildfire_flux_of_dimethyl_sulfide",
-        "wildfire_flux_of_ethane",
-        "wildfire_flux_of_ethanol",
-        "wildfire_flux_of_ethene",
-        "wildfire_flux_of_formaldehyde",
-        "wildfire_flux_of_heptane",
-        "wildfire_flux_of_hexanes",
-        "wildfire_flux_of_hexene",
-        "wildfire_flux_of_higher_alkanes",
-        "wildfire_flux_of_higher_alkenes",
-        "wildfire_flux_of_hydrogen",
-        "wildfire_flux_of_isoprene",
-        "wildfire_flux_of_methane",
-        "wildfire_flux_of_methanol",
-        "wildfire_flux_of_nitrogen_oxides",
-        "wildfire_flux_of_nitrous_oxide",
-        "wildfire_flux_of_non_methane_hydrocarbons",
-        "wildfire_flux_of_octene",
-        "wildfire_flux_of_organic_carbon",
-        "wildfire_flux_of_particulate_matter_d_2_5_µm",
-        "wildfire_flux_of_pentanes",
-        "wildfire_flux_of_pentenes",
-        "wildfire_flux_of_propane",
-        "wildfire_flux_of_propene",
-        "wildfire_flux_of_sulphur_dioxide",
-        "wildfire_flux_of_terpenes",
-        "wildfire_flux_of_toluene",
-        "wildfire_flux_of_toluene_lump",
-        "wildfire_flux_of_total_carbon_in_aerosols",
-        "wildfire_flux_of_total_particulate_matter",
-        "wildfire_flux_of_xylene",
-        "wildfire_fraction_of_area_observed",
-        "wildfire_overall_flux_of_burnt_carbon",
-        "wildfire_radiative_power",
-    ]
 
+def retrieve_from_cds(cds_date_string: str, output_file: str) -> None:
+    """
+    Submit a single GFAS retrieval to ECMWF CDS and download the result.
+
+    Args:
+        cds_date_string: CDS format date range selection, START/END.
+        output_file: Path of the file in which to store the downloaded data.
+
+    Raises:
+        RuntimeError: There was a problem setting up a connection to the CDS
+                      API, or a problem retrieving data from the CDS API.
+    """
     try:
-        CDS_CLIENT: cdsapi.Client = cdsapi.Client()
+        cds_client = cdsapi.Client()
     except Exception as exception:
-        error_message: str = (
+        error_message = (
             "\n\nThere was a problem setting up a connection to the CDS API - "
             "check the contents of your CDS API config file, usually found "
             "at ${HOME}/.cdsapirc\n"
@@ -171,20 +172,154 @@ if __name__ == "__main__":
         raise RuntimeError(error_message) from exception
 
     try:
-        CDS_CLIENT.retrieve(
+        cds_client.retrieve(
             "cams-global-fire-emissions-gfas",
-            {
-                "date": CDS_DATE_STRING,
-                "format": "netcdf",
-                "variable": CDS_DATA_FIELDS,
-            },
-            os.path.join(
-                COMMAND_LINE.output_directory[0],
-                f"GFAS_RAW_{START_DATE.year}_{str(START_DATE.month).zfill(2)}.nc",
-            ),
+            {**CDS_REQUEST_TEMPLATE, "date": cds_date_string},
+            output_file,
         )
     except Exception as exception:
-        error_message: str = (
+        error_message = (
             "There was a problem retrieving data from the CDS API"
         )
         raise RuntimeError(error_message) from exception
+
+
+def download_month(
+    month: datetime.date, output_directory: str, force: bool = False
+) -> str:
+    """
+    Download a single month of GFAS data from ECMWF CDS.
+
+    Each call constructs its own cdsapi.Client, as the client is not
+    guaranteed to be thread-safe across retrieve calls.
+
+    A CDS request can queue for hours server-side, so a month whose output
+    file already exists and is non-empty is skipped unless force is set.
+
+    Args:
+        month: The month of GFAS data to download.
+        output_directory: Directory in which to store the downloaded data file.
+        force: Download the month even when its output file already exists.
+
+    Returns:
+        The path of the downloaded data file.
+
+    Raises:
+        RuntimeError: There was a problem setting up a connection to the CDS
+                      API, or a problem retrieving data from the CDS API.
+    """
+    start_date = month
+    end_date = month_end(month)
+
+    output_file = os.path.join(
+        output_directory,
+        f"GFAS_RAW_{start_date.year}_{str(start_date.month).zfill(2)}.nc",
+    )
+
+    if (
+        not force
+        and os.path.isfile(output_file)
+        and os.path.getsize(output_file) > 0
+    ):
+        logging.info("Using cached data file %s", output_file)
+        return output_file
+
+    retrieve_from_cds(f"{start_date}/{end_date}", output_file)
+
+    return output_file
+
+
+def download_months_batched(
+    months: list[datetime.date], output_directory: str, force: bool = False
+) -> str:
+    """
+    Download a contiguous span of months in a single CDS request.
+
+    A CDS request pays one queue wait regardless of the date span it covers,
+    so batching the whole span into one request replaces one queue wait per
+    month with a single wait, at the cost of one larger download.
+
+    Args:
+        months: The months of GFAS data to download. The request spans the
+                earliest to the latest month, inclusive.
+        output_directory: Directory in which to store the downloaded data file.
+        force: Download the span even when its output file already exists.
+
+    Returns:
+        The path of the downloaded data file.
+
+    Raises:
+        RuntimeError: There was a problem setting up a connection to the CDS
+                      API, or a problem retrieving data from the CDS API.
+    """
+    start_date = min(months)
+    end_date = month_end(max(months))
+
+    output_file = os.path.join(
+        output_directory,
+        f"GFAS_RAW_{start_date.year}_{str(start_date.month).zfill(2)}"
+        f"-{end_date.year}_{str(end_date.month).zfill(2)}.nc",
+    )
+
+    if (
+        not force
+        and os.path.isfile(output_file)
+        and os.path.getsize(output_file) > 0
+    ):
+        logging.info("Using cached data file %s", output_file)
+        return output_file
+
+    retrieve_from_cds(f"{start_date}/{end_date}", output_file)
+
+    return output_file
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+    COMMAND_LINE: argparse.Namespace = parse_command_line()
+
+    # Deduplicate, preserving order - repeated months would otherwise race to
+    # write the same output file.
+    MONTHS: list[datetime.date] = list(dict.fromkeys(COMMAND_LINE.months))
+
+    if COMMAND_LINE.batch:
+        try:
+            logging.info(
+                "Downloaded %s",
+                download_months_batched(
+                    MONTHS,
+                    COMMAND_LINE.output_directory[0],
+                    COMMAND_LINE.force,
+                ),
+            )
+        except RuntimeError:
+            logging.exception("Failed to download batched months")
+            raise SystemExit(1) from None
+        raise SystemExit(0)
+
+    WORKER_COUNT: int = min(MAX_CONCURRENT_DOWNLOADS, len(MONTHS))
+
+    FAILED_MONTHS: list[datetime.date] = []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=WORKER_COUNT
+    ) as executor:
+        FUTURES: dict = {
+            executor.submit(
+                download_month,
+                month,
+                COMMAND_LINE.output_directory[0],
+                COMMAND_LINE.force,
+            ): month
+            for month in MONTHS
+        }
+
+        for future in concurrent.futures.as_completed(FUTURES):
+            month = FUTURES[future]
+            try:
+                logging.info("Downloaded %s", future.result())
+            except RuntimeError:
+                logging.exception("Failed to download month %s", month)
+                FAILED_MONTHS.append(month)
+
+    if FAILED_MONTHS:
+        raise SystemExit(1)
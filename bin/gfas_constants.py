@@ -0,0 +1,66 @@
+"""=============================================================================
+Constants shared across the GFAS pipeline scripts.
+--------------------------------------------------------------------------------
+============================================================================="""
+
+# CDS names of the GFAS data fields retrieved by get_gfas_data.py. Keep this
+# in step with config/variable_spec.json so that no bandwidth is spent
+# downloading fields that preprocess_gfas_data.py never processes.
+CDS_DATA_FIELDS: tuple[str, ...] = (
+    "altitude_of_plume_top",
+    "altitude_of_plume_bottom",
+    "injection_height",
+    "mean_altitude_of_maximum_injection",
+    "wildfire_combustion_rate",
+    "wildfire_flux_of_acetaldehyde",
+    "wildfire_flux_of_acetone",
+    "wildfire_flux_of_ammonia",
+    "wildfire_flux_of_benzene",
+    "wildfire_flux_of_black_carbon",
+    "wildfire_flux_of_butanes",
+    "wildfire_flux_of_butenes",
+    "wildfire_flux_of_carbon_dioxide",
+    "wildfire_flux_of_carbon_monoxide",
+    "wildfire_flux_of_dimethyl_sulfide",
+    "wildfire_flux_of_ethane",
+    "wildfire_flux_of_ethanol",
+    "wildfire_flux_of_ethene",
+    "wildfire_flux_of_formaldehyde",
+    "wildfire_flux_of_heptane",
+    "wildfire_flux_of_hexanes",
+    "wildfire_flux_of_hexene",
+    "wildfire_flux_of_higher_alkanes",
+    "wildfire_flux_of_higher_alkenes",
+    "wildfire_flux_of_hydrogen",
+    "wildfire_flux_of_isoprene",
+    "wildfire_flux_of_methane",
+    "wildfire_flux_of_methanol",
+    "wildfire_flux_of_nitrogen_oxides",
+    "wildfire_flux_of_nitrous_oxide",
+    "wildfire_flux_of_non_methane_hydrocarbons",
+    "wildfire_flux_of_octene",
+    "wildfire_flux_of_organic_carbon",
+    "wildfire_flux_of_particulate_matter_d_2_5_µm",
+    "wildfire_flux_of_pentanes",
+    "wildfire_flux_of_pentenes",
+    "wildfire_flux_of_propane",
+    "wildfire_flux_of_propene",
+    "wildfire_flux_of_sulphur_dioxide",
+    "wildfire_flux_of_terpenes",
+    "wildfire_flux_of_toluene",
+    "wildfire_flux_of_toluene_lump",
+    "wildfire_flux_of_total_carbon_in_aerosols",
+    "wildfire_flux_of_total_particulate_matter",
+    "wildfire_flux_of_xylene",
+    "wildfire_fraction_of_area_observed",
+    "wildfire_overall_flux_of_burnt_carbon",
+    "wildfire_radiative_power",
+)
+
+# Static portion of every CDS retrieval request. Values are immutable, so
+# callers merge in their per-request date with a shallow {**template, ...}
+# rather than copying.
+CDS_REQUEST_TEMPLATE: dict = {
+    "format": "netcdf",
+    "variable": CDS_DATA_FIELDS,
+}
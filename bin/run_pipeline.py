@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""=============================================================================
+Run the GFAS Download => Preprocess => Transfer pipeline for many months.
+
+Drives the three existing pipeline scripts as subprocesses, with a bounded
+queue between each pair of stages so that the stages overlap: while one month
+is preprocessing, the next can be downloading and the previous uploading. For
+a batch of N months the wall time approaches the slowest stage plus pipeline
+fill, instead of N times the sum of all three stages.
+============================================================================="""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import sys
+
+from get_gfas_data import date_string, directory_path
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Stage concurrency. Downloads match the CDS fair-use cap used by
+# get_gfas_data.py, preprocessing is CPU-bound so scales with cores, and two
+# concurrent uploads are enough to keep the WAN link busy.
+DOWNLOAD_WORKERS: int = 4
+PREPROCESS_WORKERS: int = os.cpu_count() or 1
+TRANSFER_WORKERS: int = 2
+
+
+def parse_command_line() -> argparse.Namespace:
+    """
+    Parse command line arguments and options
+
+    Returns:
+        argparse.Namespace containing command line arguments and options, on
+        successful parsing.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run the GFAS download/preprocess/transfer pipeline for one or "
+            "more months, overlapping the stages"
+        )
+    )
+
+    parser.add_argument(
+        "months",
+        type=date_string,
+        metavar="month {YYYY-MM}",
+        nargs="+",
+        help="The month(s) of GFAS data to run through the pipeline",
+    )
+
+    parser.add_argument(
+        "sftp_server",
+        metavar="hostname",
+        type=str,
+        help="Hostname of the SFTP server receiving preprocessed data",
+    )
+
+    parser.add_argument(
+        "sftp_directory",
+        metavar="directory_path",
+        type=str,
+        help="Directory on the SFTP server receiving preprocessed data",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--data-directory",
+        metavar="data_directory_path",
+        default="./",
+        type=directory_path,
+        help="Directory in which raw and preprocessed files are stored",
+    )
+
+    parser.add_argument(
+        "--variable-spec",
+        metavar="/path/to/variable/spec",
+        default="variable_spec.json",
+        type=str,
+        help="Variable specification passed to preprocess_gfas_data.py",
+    )
+
+    parser.add_argument(
+        "--identity-file",
+        metavar="file_path",
+        type=str,
+        help="SSH identity file passed to transfer_gfas_data.py",
+    )
+
+    return parser.parse_args()
+
+
+async def run_script(script_name: str, *arguments: str) -> int:
+    """
+    Run one of the pipeline scripts as a subprocess.
+
+    Args:
+        script_name: Name of the script in this directory to run.
+        arguments: Command line arguments to pass to the script.
+
+    Returns:
+        The subprocess exit status.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        os.path.join(SCRIPT_DIRECTORY, script_name),
+        *arguments,
+    )
+    return await process.wait()
+
+
+async def download_worker(
+    download_queue, preprocess_queue, command_line, failed_months
+):
+    """
+    Pull months from download_queue, download them with get_gfas_data.py, and
+    hand the raw files on to the preprocess stage.
+    """
+    while True:
+        month = await download_queue.get()
+
+        raw_file = os.path.join(
+            command_line.data_directory,
+            f"GFAS_RAW_{month.year}_{str(month.month).zfill(2)}.nc",
+        )
+        status = await run_script(
+            "get_gfas_data.py",
+            f"{month.year}-{str(month.month).zfill(2)}",
+            "-o",
+            command_line.data_directory,
+        )
+
+        if status == 0:
+            await preprocess_queue.put((month, raw_file))
+        else:
+            logging.error("Download failed for month %s", month)
+            failed_months.append(month)
+
+        download_queue.task_done()
+
+
+async def preprocess_worker(
+    preprocess_queue, transfer_queue, command_line, failed_months
+):
+    """
+    Pull raw files from preprocess_queue, preprocess them with
+    preprocess_gfas_data.py, and hand the results on to the transfer stage.
+    """
+    while True:
+        month, raw_file = await preprocess_queue.get()
+
+        preprocessed_file = os.path.join(
+            command_line.data_directory,
+            f"GFAS_{month.year}_{str(month.month).zfill(2)}.nc",
+        )
+        # The pipeline already runs one preprocess subprocess per core, so
+        # each one works serially - letting them each spawn their own
+        # per-variable pool would oversubscribe the machine.
+        status = await run_script(
+            "preprocess_gfas_data.py",
+            raw_file,
+            preprocessed_file,
+            "--variable-spec",
+            command_line.variable_spec,
+            "-j",
+            "1",
+        )
+
+        if status == 0:
+            await transfer_queue.put((month, preprocessed_file))
+        else:
+            logging.error("Preprocessing failed for month %s", month)
+            failed_months.append(month)
+
+        preprocess_queue.task_done()
+
+
+async def transfer_worker(transfer_queue, command_line, failed_months):
+    """
+    Pull preprocessed files from transfer_queue and upload them with
+    transfer_gfas_data.py.
+    """
+    while True:
+        month, preprocessed_file = await transfer_queue.get()
+
+        arguments = [
+            preprocessed_file,
+            command_line.sftp_server,
+            command_line.sftp_directory,
+        ]
+        if command_line.identity_file is not None:
+            arguments += ["--identity-file", command_line.identity_file]
+
+        status = await run_script("transfer_gfas_data.py", *arguments)
+
+        if status != 0:
+            logging.error("Transfer failed for month %s", month)
+            failed_months.append(month)
+
+        transfer_queue.task_done()
+
+
+async def run_pipeline(command_line) -> list[datetime.date]:
+    """
+    Run all pipeline stages for the requested months.
+
+    Returns:
+        The months for which any stage failed.
+    """
+    download_queue: asyncio.Queue = asyncio.Queue()
+    preprocess_queue: asyncio.Queue = asyncio.Queue(
+        maxsize=2 * PREPROCESS_WORKERS
+    )
+    transfer_queue: asyncio.Queue = asyncio.Queue(maxsize=2 * TRANSFER_WORKERS)
+    failed_months: list[datetime.date] = []
+
+    workers = [
+        asyncio.create_task(
+            download_worker(
+                download_queue, preprocess_queue, command_line, failed_months
+            )
+        )
+        for _ in range(DOWNLOAD_WORKERS)
+    ]
+    workers += [
+        asyncio.create_task(
+            preprocess_worker(
+                preprocess_queue, transfer_queue, command_line, failed_months
+            )
+        )
+        for _ in range(PREPROCESS_WORKERS)
+    ]
+    workers += [
+        asyncio.create_task(
+            transfer_worker(transfer_queue, command_line, failed_months)
+        )
+        for _ in range(TRANSFER_WORKERS)
+    ]
+
+    for month in dict.fromkeys(command_line.months):
+        download_queue.put_nowait(month)
+
+    await download_queue.join()
+    await preprocess_queue.join()
+    await transfer_queue.join()
+
+    for worker in workers:
+        worker.cancel()
+
+    return failed_months
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+    FAILED_MONTHS = asyncio.run(run_pipeline(parse_command_line()))
+
+    if FAILED_MONTHS:
+        raise SystemExit(1)
@@ -5,13 +5,18 @@ TRANSFER GFAS DATA
 ============================================================================="""
 import argparse
 from email.message import EmailMessage
+import functools
 import os
 import os.path
+import shlex
 import smtplib
+import subprocess
 import sys
 
 import paramiko as pm
 
+SFTP_USERNAME = "chem631"
+
 
 # ===============================================================================
 def get_script_args():
@@ -21,10 +26,11 @@ def get_script_args():
     description = "Upload preprocessed GFAS file to SFTP server"
     arg_parser = argparse.ArgumentParser(description=description)
     arg_parser.add_argument(
-        "data_file",
+        "data_files",
         metavar="data_file",
         type=str,
-        help="File to upload to SFTP server",
+        nargs="+",
+        help="File(s) to upload to SFTP server",
     )
 
     arg_parser.add_argument(
@@ -57,6 +63,16 @@ def get_script_args():
         ),
     )
 
+    arg_parser.add_argument(
+        "--use-rsync",
+        action="store_true",
+        help=(
+            "Upload with rsync over OpenSSH instead of paramiko. OpenSSH "
+            "does its crypto in native code, so this sustains much higher "
+            "throughput on fast links, but requires rsync on both ends"
+        ),
+    )
+
     return arg_parser.parse_args()
 
 
@@ -68,12 +84,14 @@ def check_input_file(filename):
         raise IOError(f"ERROR: COULD NOT OPEN INPUT FILE {filename}!\n")
 
 
+@functools.lru_cache(maxsize=1)
 def import_key(key_path="~/.ssh/id_rsa"):
     """
-    Import RSA key for authentication to webfiles.
+    Import RSA key for authentication to webfiles. Parsing a PEM key is not
+    free, so the result is cached across calls.
     """
     try:
-        key = pm.RSAKey.from_private_key_file(key_path)
+        key = pm.RSAKey.from_private_key_file(os.path.expanduser(key_path))
     except IOError:
         sys.stderr.write(f"ERROR: COULD NOT OPEN KEY FILE {key_path}!\n")
         sys.exit(1)
@@ -88,9 +106,20 @@ def get_sftp_client(hostname, key):
     host = hostname
     port = 22
 
-    transport = pm.Transport((host, port))
+    # A long-fat-network path can hold far more data in flight than the
+    # paramiko defaults allow; a 128 MiB flow-control window and 512 KiB
+    # packets keep the pipe full instead of stalling on window updates.
+    # Paramiko clamps both to whatever the protocol permits.
+    transport = pm.Transport(
+        (host, port),
+        default_window_size=2**27,
+        default_max_packet_size=2**19,
+    )
+    # The NetCDF payload is already compressed, so SSH-level compression
+    # burns CPU for no byte savings.
+    transport.use_compression(False)
     try:
-        transport.connect(username="chem631", pkey=key)
+        transport.connect(username=SFTP_USERNAME, pkey=key)
     except pm.SSHException:
         sys.stderr.write("ERROR: UNABLE TO ESTABLISH SSH CONNECTION!\n")
         sys.exit(1)
@@ -102,16 +131,71 @@ def get_sftp_client(hostname, key):
 def push_data_file(client, directory, filename):
     """
     Push preprocessed GFAS data file to webfiles.
+
+    The file is streamed through putfo with a 1 MiB local read buffer and
+    without the closing stat round-trip, which keeps the SFTP write pipeline
+    full on high-latency links.
     """
     remote_filename = os.path.join(directory, os.path.basename(filename))
-    attributes = client.put(filename, remote_filename)
+
+    # Re-pushing an unchanged multi-GB file costs tens of minutes; one stat
+    # round-trip tells us whether it is already there in full.
+    try:
+        remote_attributes = client.stat(remote_filename)
+    except IOError:
+        remote_attributes = None
+
+    if (
+        remote_attributes is not None
+        and remote_attributes.st_size == os.path.getsize(filename)
+    ):
+        sys.stderr.write(
+            f"INFO: {remote_filename} already up to date, skipping upload\n"
+        )
+        return remote_attributes
+
+    with open(filename, "rb", buffering=1 << 20) as local_file:
+        attributes = client.putfo(
+            local_file,
+            remote_filename,
+            file_size=os.path.getsize(filename),
+            confirm=False,
+        )
     return attributes
 
 
-def send_notification_email(url):
+def push_data_file_rsync(hostname, directory, filename, identity_file=None):
     """
-    Send notification email to GCST with URL of data file.
+    Push preprocessed GFAS data file to webfiles using rsync over OpenSSH.
     """
+    ssh_command = "ssh -c aes128-gcm@openssh.com"
+    if identity_file is not None:
+        ssh_command += f" -i {shlex.quote(identity_file)}"
+
+    try:
+        subprocess.run(
+            [
+                "rsync",
+                "--partial",
+                "--inplace",
+                "-e",
+                ssh_command,
+                filename,
+                f"{SFTP_USERNAME}@{hostname}:{directory}/",
+            ],
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        sys.stderr.write("ERROR: RSYNC UPLOAD FAILED!\n")
+        sys.exit(1)
+
+
+def send_notification_email(urls):
+    """
+    Send notification email to GCST with the URL of each data file.
+    """
+    url_listing = "\n".join(urls)
+
     msg = EmailMessage()
     msg.set_content(
         (
@@ -119,7 +203,7 @@ def send_notification_email(url):
             "This is an automated message to let you know that last"
             " month's GFAS data is ready to be downloaded.\n\n"
             "You can find the data at:\n\n"
-            f"{url}\n\n"
+            f"{url_listing}\n\n"
             "If there are any problems with this data, please let me"
             " know.\n\n"
             "Killian"
@@ -138,23 +222,40 @@ def send_notification_email(url):
 if __name__ == "__main__":
     script_args = get_script_args()
 
-    check_input_file(script_args.data_file)
+    for data_file in script_args.data_files:
+        check_input_file(data_file)
     if script_args.identity_file is not None:
         check_input_file(script_args.identity_file)
 
-    if script_args.identity_file is not None:
-        client_key = import_key(script_args.identity_file)
+    if script_args.use_rsync:
+        for data_file in script_args.data_files:
+            push_data_file_rsync(
+                script_args.sftp_server,
+                script_args.sftp_directory,
+                data_file,
+                script_args.identity_file,
+            )
     else:
-        client_key = import_key()
+        if script_args.identity_file is not None:
+            client_key = import_key(script_args.identity_file)
+        else:
+            client_key = import_key()
 
-    sftp_client = get_sftp_client(script_args.sftp_server, client_key)
-    push_data_file(
-        sftp_client,
-        script_args.sftp_directory,
-        script_args.data_file,
-    )
-    sftp_client.close()
+        # One SSH handshake is plenty - reuse the same connection for every
+        # file instead of paying key exchange and auth per upload.
+        sftp_client = get_sftp_client(script_args.sftp_server, client_key)
+        for data_file in script_args.data_files:
+            push_data_file(
+                sftp_client,
+                script_args.sftp_directory,
+                data_file,
+            )
+        sftp_client.close()
 
     URL_PREFIX = "https://webfiles.york.ac.uk/WACL/GFAS/INCOMING/"
-    url_suffix = os.path.basename(script_args.data_file)
-    send_notification_email(f"{URL_PREFIX}{url_suffix}")
+    send_notification_email(
+        [
+            f"{URL_PREFIX}{os.path.basename(data_file)}"
+            for data_file in script_args.data_files
+        ]
+    )